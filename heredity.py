@@ -1,5 +1,7 @@
 import csv
 import itertools
+import math
+import operator
 import sys
 
 PROBS = {
@@ -36,6 +38,35 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Probability of a parent passing the gene on given its number of genes
+PASS = {
+    2: 1 - PROBS["mutation"],
+    1: 0.5, # Mutations cancel out in this case
+    0: PROBS["mutation"]
+}
+
+# Unconditional probabilities for having gene, indexed by number of genes
+GENE = [PROBS["gene"][gene] for gene in range(3)]
+
+# Probability of a child's number of genes given its parents' number of
+# genes, indexed as TRANS[gene][mother_gene][father_gene]
+TRANS = [
+
+    # Neither parent passes the gene on
+    [[(1 - PASS[m]) * (1 - PASS[f]) for f in range(3)] for m in range(3)],
+
+    # Exactly one parent passes the gene on
+    [[PASS[m] * (1 - PASS[f]) + (1 - PASS[m]) * PASS[f] for f in range(3)]
+     for m in range(3)],
+
+    # Both parents pass the gene on
+    [[PASS[m] * PASS[f] for f in range(3)] for m in range(3)]
+]
+
+# Probability of trait given number of genes, indexed as TRAIT[gene][trait]
+TRAIT = [[PROBS["trait"][gene][trait] for trait in (False, True)]
+         for gene in range(3)]
+
 
 def main():
 
@@ -44,43 +75,30 @@ def main():
         sys.exit("Usage: python heredity.py data.csv")
     people = load_data(sys.argv[1])
 
+    # Flatten the family into lists indexed by position in `people`
+    mother, father = parent_positions(people)
+    evidence = [people[person]["trait"] for person in people]
+
+    # Gene and trait probabilities by position, as gene[i][value]
+    # and trait[i][value]
+    gene, trait = marginals(mother, father, evidence)
+
     # Keep track of gene and trait probabilities for each person
     probabilities = {
         person: {
             "gene": {
-                2: 0,
-                1: 0,
-                0: 0
+                2: gene[i][2],
+                1: gene[i][1],
+                0: gene[i][0]
             },
             "trait": {
-                True: 0,
-                False: 0
+                True: trait[i][True],
+                False: trait[i][False]
             }
         }
-        for person in people
+        for i, person in enumerate(people)
     }
 
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
-
     # Ensure probabilities sum to 1
     normalize(probabilities)
 
@@ -116,16 +134,25 @@ def load_data(filename):
     return data
 
 
-def powerset(s):
+def parent_positions(people):
     """
-    Return a list of all possible subsets of set s.
+    Returns lists `mother` and `father` with the position in `people`
+    of each person's parents, or -1 if they are unknown.
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    index = {person: i for i, person in enumerate(people)}
+    mother = []
+    father = []
+
+    for person in people:
+        if people[person]["mother"] and people[person]["father"]:
+            mother.append(index[people[person]["mother"]])
+            father.append(index[people[person]["father"]])
+
+        else:
+            mother.append(-1)
+            father.append(-1)
+
+    return mother, father
 
 
 def genes_dict(people, one_gene, two_genes):
@@ -148,102 +175,282 @@ def genes_dict(people, one_gene, two_genes):
     return genes
 
 
-def joint_probability(people, one_gene, two_genes, have_trait):
+def person_probability(gene, mother_gene, father_gene, trait):
+    """
+    Returns the probability that a person has `gene` copies of the gene
+    and, unless `trait` is None, that they have `trait`.
+    `mother_gene` and `father_gene` are the parents' number of genes,
+    or None if the person has no parents.
     """
-    Compute and return a joint probability.
 
-    The probability returned should be the probability that
-        * everyone in set `one_gene` has one copy of the gene, and
-        * everyone in set `two_genes` has two copies of the gene, and
-        * everyone not in `one_gene` or `two_gene` does not have the gene, and
-        * everyone in set `have_trait` has the trait, and
-        * everyone not in set` have_trait` does not have the trait.
+    # Has parents:
+    if mother_gene is not None and father_gene is not None:
+        prob = TRANS[gene][mother_gene][father_gene]
+
+    # Has no parents:
+    else:
+        prob = GENE[gene]
+
+    # Traits (unknown ones sum out to 1 and leave only the genes):
+    if trait is not None:
+        prob *= TRAIT[gene][trait]
+
+    return prob
+
+
+def person_factors(mother, father, evidence):
+    """
+    Returns a list with each person's factor of the joint probability,
+    combining the probability of their genes and of their known trait.
+    `mother` and `father` are as returned by `parent_positions` and
+    `evidence` holds each person's known trait, or None if it is unknown.
+    Factors are (scope, table) pairs as described in `multiply`.
     """
+    factors = []
 
-    # Number of genes in the given scenario.
-    genes = genes_dict(people, one_gene, two_genes)
+    for i, (m, f) in enumerate(zip(mother, father)):
 
-    joint = 1
+        # Has parents:
+        if m >= 0 and f >= 0:
+            factors.append(((i, m, f), {
+                (g, mg, fg): log(person_probability(g, mg, fg, evidence[i]))
+                for g in range(3) for mg in range(3) for fg in range(3)
+            }))
+
+        # Has no parents:
+        else:
+            factors.append(((i,), {
+                (g,): log(person_probability(g, None, None, evidence[i]))
+                for g in range(3)
+            }))
+
+    return factors
+
+
+def multiply(factors):
+    """
+    Returns the product of `factors` as a single factor.
+    Each factor is a (scope, table) pair, where `scope` is a tuple with the
+    positions of the people it depends on and `table` maps each tuple of
+    their numbers of genes to a log-probability.
+    """
+    scope = tuple(sorted({person for s, _ in factors for person in s}))
+    table = dict()
+
+    # Read each factor's genes from a row with an itemgetter, which only
+    # returns a tuple when given at least two positions
+    lookups = []
+    for s, t in factors:
+        position = tuple(scope.index(person) for person in s)
+
+        if len(position) > 1:
+            get = operator.itemgetter(*position)
+        else:
+            get = lambda genes, position=position: tuple(
+                genes[k] for k in position
+            )
+
+        lookups.append((get, t))
+
+    for genes in itertools.product((0, 1, 2), repeat=len(scope)):
+        log_prob = 0
+
+        for get, t in lookups:
+            log_prob += t[get(genes)]
+
+        table[genes] = log_prob
+
+    return scope, table
 
-    for person in people:
-        prob = 1
 
-        # Two genes in the scenario:
-        if genes[person] == 2:
+def log(p):
+    """
+    Returns the natural logarithm of `p`, or -inf if `p` is zero.
+    """
+    return math.log(p) if p > 0 else -math.inf
 
-            # Has parents:
-            if people[person]["mother"] and people[person]["father"]:
 
-                for parent in [people[person]["mother"], people[person]["father"]]:
+def logsumexp(values):
+    """
+    Returns log(sum(exp(v) for v in values)) without underflowing.
+    """
+    top = max(values)
+    if top == -math.inf:
+        return top
 
-                    if genes[parent] == 2:
-                        prob *= 1 - PROBS["mutation"]
-                    
-                    elif genes[parent] == 1:
-                        prob *= 0.5 # Mutations cancel out in this case
+    return top + math.log(sum(math.exp(v - top) for v in values))
 
-                    else:
-                        prob *= PROBS["mutation"]
-                    
-            # Has no parents:
-            else:
-                prob *= PROBS["gene"][2]
-        
-        # One gene in the scenario:
-        elif genes[person] == 1:
-            
-            # Has parents:
-            if people[person]["mother"] and people[person]["father"]:
 
-                sum = genes[people[person]["mother"]] + genes[people[person]["father"]]
-                
-                if sum == 4 or sum == 0:
-                    prob *= 2 * PROBS["mutation"] * (1 - PROBS["mutation"])
+def sum_out(person, factor):
+    """
+    Returns `factor` with the number of genes of `person` summed out.
+    """
+    scope, table = factor
+    k = scope.index(person)
+    terms = dict()
 
-                elif sum == 3:
-                    prob *= 0.5 # All mutations cancel out
+    for genes, log_prob in table.items():
+        terms.setdefault(genes[:k] + genes[k + 1:], []).append(log_prob)
+
+    summed = {genes: logsumexp(values) for genes, values in terms.items()}
+    return scope[:k] + scope[k + 1:], summed
+
+
+def marginalize(factor, keep):
+    """
+    Returns `factor` with everyone not in set `keep` summed out.
+    """
+    for person in factor[0]:
+        if person not in keep:
+            factor = sum_out(person, factor)
 
-                elif sum == 2:
-                    
-                    if genes[people[person]["mother"]] == 1:
-                        prob *= 0.5 # All mutations cancel out
+    return factor
 
-                    else:
-                        prob *= 1 - 2 * PROBS["mutation"] + 2 * PROBS["mutation"]**2
 
-                elif sum == 1:
-                    prob *= 0.5 # All mutations cancel out
+def clique_tree(factors):
+    """
+    Returns the order in which to sum people out of `factors` and, for each
+    person, the clique (set of people) formed when they are summed out and
+    the person whose clique receives its message, or None for a root.
+    """
+    neighbors = dict()
+    for scope, _ in factors:
+        for person in scope:
+            neighbors.setdefault(person, set()).update(scope)
+
+    for person in neighbors:
+        neighbors[person].discard(person)
+
+    order = []
+    cliques = dict()
+    remaining = set(neighbors)
+
+    while remaining:
+
+        # Sum out whoever yields the smallest clique, which for a
+        # family tree means leaves first, then their parents
+        person = min(remaining, key=lambda p: len(neighbors[p]))
+        rest = neighbors[person]
+        cliques[person] = rest | {person}
+
+        for other in rest:
+            neighbors[other] |= rest - {other}
+            neighbors[other].discard(person)
+
+        remaining.remove(person)
+        order.append(person)
+
+    # A clique passes its message to the clique of whoever in it is
+    # summed out next
+    position = {person: k for k, person in enumerate(order)}
+    parent = {
+        person: min(cliques[person] - {person}, key=position.get, default=None)
+        for person in order
+    }
 
+    return order, cliques, parent
 
-            # Has no parents:
-            else:
-                prob *= PROBS["gene"][1]
 
-        # Zero gene in the scenario:
+def marginals(mother, father, evidence):
+    """
+    Compute each person's gene and trait distributions by variable
+    elimination over the family tree.
+    `mother`, `father` and `evidence` are as in `person_factors`.
+    Returns lists `gene` and `trait` such that gene[i][g] and trait[i][t]
+    are the (unnormalized) probabilities for the i-th person.
+    """
+    factors = person_factors(mother, father, evidence)
+    order, cliques, parent = clique_tree(factors)
+
+    # Each factor belongs to the clique of the first person it
+    # mentions to be summed out
+    position = {person: k for k, person in enumerate(order)}
+    potentials = {person: [] for person in order}
+    for factor in factors:
+        potentials[min(factor[0], key=position.get)].append(factor)
+
+    children = {person: [] for person in order}
+    for person in order:
+        if parent[person] is not None:
+            children[parent[person]].append(person)
+
+    # Upward pass, leaves first: each clique sends its parent everything
+    # below it, with all but the people they share summed out
+    up = dict()
+    for person in order:
+        if parent[person] is not None:
+            incoming = [up[child] for child in children[person]]
+            up[person] = marginalize(
+                multiply(potentials[person] + incoming),
+                cliques[person] - {person}
+            )
+
+    # Downward pass, roots first: each clique sends each child everything
+    # outside that child's subtree
+    down = dict()
+    for person in reversed(order):
+        for child in children[person]:
+            incoming = [up[other] for other in children[person] if other != child]
+            if parent[person] is not None:
+                incoming.append(down[person])
+
+            down[child] = marginalize(
+                multiply(potentials[person] + incoming),
+                cliques[child] - {child}
+            )
+
+    gene = []
+    for i in range(len(evidence)):
+        incoming = [up[child] for child in children[i]]
+        if parent[i] is not None:
+            incoming.append(down[i])
+
+        scope, table = marginalize(multiply(potentials[i] + incoming), {i})
+
+        # Scale by the largest term so that exponentiating cannot underflow
+        top = max(table.values())
+        gene.append([math.exp(table[(g,)] - top) for g in range(3)])
+
+    trait = []
+    for i, known in enumerate(evidence):
+        if known is None:
+            trait.append([
+                sum(gene[i][g] * TRAIT[g][t] for g in range(3))
+                for t in range(2)
+            ])
         else:
-            
-            # Has parents:
-            if people[person]["mother"] and people[person]["father"]:
-                
-                for parent in [people[person]["mother"], people[person]["father"]]:
+            trait.append([sum(gene[i]) if t == known else 0 for t in range(2)])
 
-                    if genes[parent] == 2:
-                        prob *= PROBS["mutation"]
+    return gene, trait
 
-                    elif genes[parent] == 1:
-                        prob *= 0.5
 
-                    else:
-                        prob *= 1 - PROBS["mutation"]
+def joint_probability(people, one_gene, two_genes, have_trait):
+    """
+    Compute and return a joint probability.
+
+    The probability returned should be the probability that
+        * everyone in set `one_gene` has one copy of the gene, and
+        * everyone in set `two_genes` has two copies of the gene, and
+        * everyone not in `one_gene` or `two_gene` does not have the gene, and
+        * everyone in set `have_trait` has the trait, and
+        * everyone not in set` have_trait` does not have the trait.
+    """
 
-            # Has no parents:
-            else:
-                prob *= PROBS["gene"][0]
+    # Number of genes in the given scenario.
+    genes = genes_dict(people, one_gene, two_genes)
 
-        # Traits:
-        prob *= PROBS["trait"][genes[person]][person in have_trait]
+    joint = 1
 
-        joint *= prob
+    for person in people:
+        mother = people[person]["mother"]
+        father = people[person]["father"]
+
+        joint *= person_probability(
+            genes[person],
+            genes[mother] if mother else None,
+            genes[father] if father else None,
+            person in have_trait
+        )
 
     return joint
 
@@ -271,13 +478,10 @@ def normalize(probabilities):
     
     for person in probabilities:
         for dist in probabilities[person]:
-            sum = 0
+            total = sum(probabilities[person][dist].values())
 
             for value in probabilities[person][dist]:
-                sum += probabilities[person][dist][value]
-            
-            for value in probabilities[person][dist]:
-                probabilities[person][dist][value] /= sum
+                probabilities[person][dist][value] /= total
 
 
 if __name__ == "__main__":